@@ -19,7 +19,6 @@
 
 import argparse
 from datetime import datetime, timedelta
-from distutils.version import LooseVersion
 import json
 import logging
 import os
@@ -27,7 +26,15 @@ import subprocess
 import sys
 from textwrap import dedent
 import time
-import yaml
+# yaml and distutils are slow to import, so they are imported where
+# they are needed. Quick exits such as --version and --description
+# start faster this way.
+
+try:
+    # orjson is optional, but much faster at parsing status of large models.
+    import orjson as status_json
+except ImportError:
+    status_json = json
 
 
 __version__ = '2.5.0'
@@ -55,12 +62,15 @@ class JujuWaitException(Exception):
     pass
 
 
-def run_or_die(cmd, env=None):
+def run_or_die(cmd, env=None, text=True):
+    # This is deliberately synchronous. Other tools call into juju_wait,
+    # possibly from a running asyncio event loop where asyncio.run()
+    # would fail.
     try:
         # It is important we don't mix stdout and stderr, as stderr
         # will often contain SSH noise we need to ignore due to Juju's
         # lack of SSH host key handling.
-        p = subprocess.Popen(cmd, universal_newlines=True, env=env,
+        p = subprocess.Popen(cmd, universal_newlines=text, env=env,
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         (out, err) = p.communicate()
     except OSError as x:
@@ -70,7 +80,7 @@ def run_or_die(cmd, env=None):
         logging.error("{} failed: {}".format(' '.join(cmd), x))
         raise JujuWaitException(42)
     if p.returncode != 0:
-        logging.error(err)
+        logging.error(err if text else err.decode('UTF-8', 'replace'))
         logging.error("{} failed: {}".format(' '.join(cmd), p.returncode))
         raise JujuWaitException(p.returncode or 43)
     return out
@@ -101,6 +111,7 @@ def juju_run(unit, cmd, timeout=None):
 
 
 def juju_run_many(units, cmd, timeout=None):
+    import yaml
     units = list(units)
     if not units:
         return {}
@@ -109,20 +120,42 @@ def juju_run_many(units, cmd, timeout=None):
         args.append('--timeout={}s'.format(timeout))
     args.extend(['--', cmd])
     out = yaml.safe_load(run_or_die(args))
-    # ReturnCode is omitted from the YAML when 0, so assume absence is
-    # success.
-    return {d['UnitId']: (d.get('ReturnCode', 0), d['Stdout']) for d in out}
+    results = {}
+    for d in out:
+        # ReturnCode is omitted from the YAML when 0, so assume absence is
+        # success. Failures to run the command at all, such as timeouts,
+        # are reported in Error instead, with no ReturnCode or Stdout.
+        return_code = d.get('ReturnCode', 0)
+        if d.get('Error'):
+            logging.error("{} failed: {}".format(d['UnitId'], d['Error']))
+            return_code = return_code or 1
+        results[d['UnitId']] = (return_code, d.get('Stdout', ''))
+    return results
 
 
 def get_status():
     # Older juju versions don't support --utc, so force UTC timestamps
-    # using the environment variable.
+    # using the environment variable. The environment is copied on every
+    # call, so changes made between calls (JUJU_DATA, HOME, PATH...) are
+    # honoured.
     env = os.environ.copy()
     env['TZ'] = 'UTC'
-    json_status = run_or_die([juju_exe(), 'status', '--format=json'], env=env)
+    # We run a fresh 'juju status' each poll rather than keeping a
+    # long lived process feeding us updates. Juju versions we support
+    # have no way of streaming status, and a shell loop running
+    # 'juju status' would pay the same process and connection costs
+    # while ignoring our adaptive poll interval.
+    #
+    # Status can be megabytes on large models, so parse the raw output
+    # rather than decoding it to text first.
+    json_status = run_or_die([juju_exe(), 'status', '--format=json'],
+                             env=env, text=False)
     if json_status is None:
         return None
-    return json.loads(json_status)
+    if status_json is json and sys.version_info < (3, 6):
+        # json.loads() only accepts bytes from Python 3.6.
+        json_status = json_status.decode('UTF-8')
+    return status_json.loads(json_status)
 
 
 def get_log_tail(unit, timeout=None):
@@ -131,6 +164,48 @@ def get_log_tail(unit, timeout=None):
     return juju_run(unit, cmd, timeout=timeout)
 
 
+def parse_log_sig(out):
+    '''Parse the (mtime, size) of a unit log from stat(1) output.'''
+    fields = out.split()
+    if len(fields) != 2:
+        raise ValueError('Expected mtime and size, got {!r}'.format(out))
+    return (int(fields[0]), int(fields[1]))
+
+
+# Shell command run on every unit at once by get_log_sigs(), so it
+# needs to find the unit's log from the hook environment.
+LOG_SIG_CMD = ('sudo stat -c "%Y %s" '
+               '/var/log/juju/unit-$(echo $JUJU_UNIT_NAME | tr / -).log')
+
+
+def get_log_sigs(units, timeout=None):
+    '''Return the (mtime, size) of the logs of the units, keyed by unit.
+
+    The log is untouched while no hooks are running, so this is enough
+    to detect hook activity without transferring any log content. A
+    single 'juju run' checks all the units, rather than paying for a
+    separate process and controller connection per unit.
+    '''
+    results = juju_run_many(units, LOG_SIG_CMD, timeout)
+    log_sigs = {}
+    failed = False
+    for unit, (return_code, stdout) in results.items():
+        if return_code != 0:
+            logging.error("{} has failed. Unable to check log activity."
+                          "".format(unit))
+            failed = True
+            continue
+        try:
+            log_sigs[unit] = parse_log_sig(stdout)
+        except ValueError:
+            logging.error("{} has failed. Insane output from commands."
+                          "".format(unit))
+            failed = True
+    if failed:
+        raise JujuWaitException(44)
+    return log_sigs
+
+
 def leadership_poll(units):
     is_leader_results = juju_run_many(units, 'is-leader --format=json')
     unit_map = {}
@@ -159,20 +234,36 @@ def leadership_poll(units):
 # still due to be run.
 IDLE_CONFIRMATION = timedelta(seconds=15)
 
+# Poll frequently while the environment is changing, backing off to
+# poll less often while status remains unchanged.
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 5.0
+
 # If all units have one of the following workload status values,
 # consider them ready.  Not all charms use workload the status feature.
 # Those that do not will be represented by the 'unknown' value and
 # workload status will be ignored.  For charms that do, wait for an
 # 'active' workload status value.  FYI: blocked, waiting, maintenance
 # values indicate not-ready workload states.
-WORKLOAD_OK_STATES = ['active', 'unknown']
+WORKLOAD_OK_STATES = frozenset(['active', 'unknown'])
 
 # If any unit ever reaches one of the following workload status
 # values, consider that fatal and raise.
-WORKLOAD_ERROR_STATES = ['error']
+WORKLOAD_ERROR_STATES = frozenset(['error'])
 
+# Services and units with one of these life values are going away,
+# so the environment is not yet quiescent.
+DEAD_LIFE_STATES = frozenset(['dying', 'dead'])
 
-def wait_cmd(args=sys.argv[1:]):
+
+# The argument parser, built on first use by arg_parser().
+_parser = None
+
+
+def arg_parser():
+    global _parser
+    if _parser is not None:
+        return _parser
     description = dedent("""\
         Wait for environment steady state.
 
@@ -196,6 +287,12 @@ def wait_cmd(args=sys.argv[1:]):
                         help='Maximum time to wait for readiness (seconds)',
                         action='store', default=None)
     parser.add_argument('--version', default=False, action='store_true')
+    _parser = parser
+    return parser
+
+
+def wait_cmd(args=sys.argv[1:]):
+    parser = arg_parser()
     args = parser.parse_args(args)
 
     if args.version:
@@ -236,6 +333,56 @@ def reset_logging():
                 'logging-config=juju=WARNING;unit=INFO'])
 
 
+def classify_units(services):
+    '''Flatten the unit and subordinate details from status.
+
+    Returns (all_units, ready_units, workload_status, agent_status,
+    agent_version, unit_leadership).
+    '''
+    all_units = set()  # All units, including subordinates.
+
+    # 'ready' units are up, and might be idle. They need to have their
+    # logs sniffed because they are running Juju 1.23 or earlier.
+    ready_units = {}
+
+    # Flattened agent and workload status and leadership for all units
+    # and subordinates that provide it. Note that 'agent status' is only
+    # available in Juju 1.24 and later. This is easily confused with
+    # 'agent state' which is available in earlier versions of Juju.
+    workload_status = {}
+    agent_status = {}
+    agent_version = {}
+    unit_leadership = {}
+    for service in services.values():
+        for uname, unit in service.get('units', {}).items():
+            all_units.add(uname)
+            # Subordinates are handled the same way as their principal.
+            members = [(uname, unit)]
+            members.extend(unit.get('subordinates', {}).items())
+            for mname, member in members:
+                unit_leadership[mname] = member.get('leader')
+                # agent-status was renamed to juju-status, and
+                # agent-version became a subkey of juju-status, some
+                # time during the Juju 2.0 beta cycle.
+                juju_status = member.get('juju-status') or {}
+                if 'agent-version' in member:
+                    agent_version[mname] = member['agent-version']
+                elif 'version' in juju_status:
+                    agent_version[mname] = juju_status['version']
+
+                wstatus = member.get('workload-status')
+                if wstatus and 'current' in wstatus:
+                    workload_status[mname] = wstatus
+
+                astatus = member.get('agent-status') or juju_status
+                if astatus:
+                    agent_status[mname] = astatus
+                else:
+                    ready_units[mname] = member  # Schedule for sniffing.
+    return (all_units, ready_units, workload_status, agent_status,
+            agent_version, unit_leadership)
+
+
 def wait(log=None, wait_for_workload=False, max_wait=None):
     # Note that wait_for_workload is only useful as a workaround for
     # broken setups. It is impossible for a charm to report that it has
@@ -250,7 +397,12 @@ def wait(log=None, wait_for_workload=False, max_wait=None):
 
     # pre-juju 1.24, we can only detect idleless by looking for changes
     # in the logs.
-    prev_logs = {}
+    prev_log_sigs = {}
+
+    # Services from the previous poll, to tell if anything has changed.
+    # The raw status cannot be compared, as it includes a timestamp.
+    prev_services = None
+    delay = MIN_POLL_INTERVAL
 
     epoch_started = time.time()
     ready_since = None
@@ -258,6 +410,8 @@ def wait(log=None, wait_for_workload=False, max_wait=None):
 
     while True:
         status = get_status()
+        # All time comparisons in this poll are against this instant.
+        now = datetime.utcnow()
         ready = True
 
         # If defined, fail if max_wait is exceeded
@@ -269,80 +423,28 @@ def wait(log=None, wait_for_workload=False, max_wait=None):
 
         # If there is a dying service, environment is not quiescent.
         services = status.get('services') or status.get('applications', {})
+        services_unchanged = services == prev_services
+        prev_services = services
         for sname, service in sorted(services.items()):
-            if service.get('life') in ('dying', 'dead'):
+            if service.get('life') in DEAD_LIFE_STATES:
                 logging.debug('{} is dying'.format(sname))
                 ready = False
 
-        all_units = set()  # All units, including subordinates.
-
-        # 'ready' units are up, and might be idle. They need to have their
-        # logs sniffed because they are running Juju 1.23 or earlier.
-        ready_units = {}
-
-        # Flattened agent and workload status and leadership for all units
-        # and subordinates that provide it. Note that 'agent status' is only
-        # available in Juju 1.24 and later. This is easily confused with
-        # 'agent state' which is available in earlier versions of Juju.
-        workload_status = {}
-        agent_status = {}
-        agent_version = {}
-        unit_leadership = {}
-        for sname, service in services.items():
-            for uname, unit in service.get('units', {}).items():
-                all_units.add(uname)
-                unit_leadership[uname] = unit.get('leader', None)
-                if 'agent-version' in unit:
-                    agent_version[uname] = unit.get('agent-version')
-                elif 'juju-status' in unit and ('version'
-                                                in unit['juju-status']):
-                    # agent-version disappeared and was replaced by
-                    # a subkey of juju-status some time during the Juju
-                    # 2.0 beta cycle.
-                    agent_version[uname] = unit['juju-status']['version']
-                if ('workload-status' in unit and
-                        'current' in unit['workload-status']):
-                    workload_status[uname] = unit['workload-status']
-
-                if 'agent-status' in unit and unit['agent-status'] != {}:
-                    agent_status[uname] = unit['agent-status']
-                elif 'juju-status' in unit and unit['juju-status'] != {}:
-                    # agent-status was renamed to juju-status some time
-                    # during the Juju 2.0 beta cycle.
-                    agent_status[uname] = unit['juju-status']
-                else:
-                    ready_units[uname] = unit  # Schedule for sniffing.
-                for subname, sub in unit.get('subordinates', {}).items():
-                    unit_leadership[subname] = sub.get('leader', None)
-                    if ('workload-status' in sub and
-                            'current' in sub['workload-status']):
-                        workload_status[subname] = sub['workload-status']
-
-                    if 'agent-version' in sub:
-                        agent_version[subname] = sub['agent-version']
-                    elif 'juju-status' in sub and ('version' in
-                                                   sub['juju-status']):
-                        agent_version[subname] = sub['juju-status']['version']
-                    if 'agent-status' in sub and unit['agent-status'] != {}:
-                        agent_status[subname] = sub['agent-status']
-                    elif 'juju-status' in sub and unit['juju-status'] != {}:
-                        # agent-status was renamed to juju-status some time
-                        # during the Juju 2.0 beta cycle.
-                        agent_status[subname] = sub['juju-status']
-                    else:
-                        ready_units[subname] = sub  # Schedule for sniffing.
+        (all_units, ready_units, workload_status, agent_status,
+         agent_version, unit_leadership) = classify_units(services)
 
         for uname, wstatus in sorted(workload_status.items()):
-            if not ('current' in wstatus and 'since' in wstatus):
+            current = wstatus.get('current')
+            since = wstatus.get('since')
+            if current is None or since is None:
                 ready = False
                 continue
-            current = wstatus['current']
-            since = parse_ts(wstatus['since'])
 
-            # Check workload status
+            # Check workload status. The timestamp is only parsed when
+            # it is needed for reporting.
             if current not in WORKLOAD_OK_STATES and wait_for_workload:
                 logging.debug('{} workload status is {} since '
-                              '{}Z'.format(uname, current, since))
+                              '{}Z'.format(uname, current, parse_ts(since)))
                 ready = False
 
             # Fail and raise if workload state is ever in error
@@ -353,33 +455,31 @@ def wait(log=None, wait_for_workload=False, max_wait=None):
                 raise JujuWaitException(1)
 
         for uname, astatus in sorted(agent_status.items()):
-            if not ('current' in astatus and 'since' in astatus):
+            current = astatus.get('current')
+            since = astatus.get('since')
+            if current is None or since is None:
                 ready = False
                 continue
-            current = astatus['current']
-            since = parse_ts(astatus['since'])
-            if 'message' in astatus:
-                message = astatus['message']
-            else:
-                message = ''
 
             # Check agent status
-            if (current == 'executing' and
-                    message == 'running update-status hook'):
+            if current == 'idle':
+                pass
+            elif (current == 'executing' and
+                    astatus.get('message') == 'running update-status hook'):
                 # update-status is an idle hook event
                 pass
-            elif current != 'idle':
+            else:
                 logging.debug('{} juju agent status is {} since '
-                              '{}Z'.format(uname, current, since))
+                              '{}Z'.format(uname, current, parse_ts(since)))
                 ready = False
 
-        # Log storage to compare with prev_logs.
-        logs = {}
+        # Log signatures to compare with prev_log_sigs.
+        log_sigs = {}
 
         # Sniff logs of units that don't provide agent-status, if necessary.
         # This section can go when we drop support for Juju < 1.24.
         for uname, unit in sorted(ready_units.items()):
-            dying = unit.get('life') in ('dying', 'dead')
+            dying = unit.get('life') in DEAD_LIFE_STATES
             agent_state = unit.get('agent-state')
             agent_state_info = unit.get('agent-state-info')
             if dying:
@@ -392,23 +492,32 @@ def wait(log=None, wait_for_workload=False, max_wait=None):
             elif agent_state != 'started':
                 logging.debug('{} is {}'.format(uname, agent_state))
                 ready = False
-            elif ready:
-                # We only start grabbing the logs once all the units
-                # are in a suitable lifecycle state. If we don't do this,
-                # we risk attempting to grab logs from units or subordinates
-                # that are not yet ready to respond, or have disappeared
-                # since we last checked the environment status.
-                if not logging_reset:
-                    reset_logging()
-                    logging_reset = True
-                logs[uname] = get_log_tail(uname)
-                if logs[uname] == prev_logs.get(uname):
-                    logging.debug('{} is idle - no hook activity'
-                                  ''.format(uname))
-                else:
-                    logging.debug('{} is active: {}'
-                                  ''.format(uname, logs[uname].strip()))
-                    ready = False
+
+        # We only start grabbing the logs once all the units are in a
+        # suitable lifecycle state. If we don't do this, we risk
+        # attempting to grab logs from units or subordinates that are
+        # not yet ready to respond, or have disappeared since we last
+        # checked the environment status.
+        if ready and ready_units:
+            if not logging_reset:
+                reset_logging()
+                logging_reset = True
+            # These units report no agent-status, so there is no change
+            # timestamp in status we could use to skip checking their
+            # logs. Hooks can run without their agent-state changing,
+            # so the logs must be checked on every poll.
+            log_sigs = get_log_sigs(ready_units)
+            if log_sigs != prev_log_sigs:
+                ready = False
+            # Per unit details are only needed for debug output.
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                for uname in sorted(log_sigs):
+                    if log_sigs[uname] == prev_log_sigs.get(uname):
+                        logging.debug('{} is idle - no hook activity'
+                                      ''.format(uname))
+                    else:
+                        logging.debug('{} is active - log has changed'
+                                      ''.format(uname))
 
         if ready:
             # We are never ready until this check has been running until
@@ -417,9 +526,9 @@ def wait(log=None, wait_for_workload=False, max_wait=None):
             # 'juju upgrade-charm', then the scheduled operation has had
             # a chance to fire any hooks it is going to.
             if ready_since is None:
-                ready_since = datetime.utcnow()
+                ready_since = now
                 ready = False
-            elif ready_since + IDLE_CONFIRMATION < datetime.utcnow():
+            elif ready_since + IDLE_CONFIRMATION < now:
                 logging.info('All units idle since {}Z ({})'
                              ''.format(ready_since,
                                        ', '.join(sorted(all_units))))
@@ -434,6 +543,7 @@ def wait(log=None, wait_for_workload=False, max_wait=None):
         # Run last as it can take quite awhile on environments with a
         # large number of services.
         if ready:
+            from distutils.version import LooseVersion
             for uname, ver in agent_version.items():
                 if ver and LooseVersion(ver) < LooseVersion('1.24'):
                     # Leadership was added in 1.24, so short-circuit to true
@@ -474,8 +584,20 @@ def wait(log=None, wait_for_workload=False, max_wait=None):
         if ready:
             return
 
-        prev_logs = logs
-        time.sleep(4)
+        if services_unchanged and log_sigs == prev_log_sigs:
+            delay = min(delay * 1.5, MAX_POLL_INTERVAL)
+        else:
+            delay = MIN_POLL_INTERVAL
+        prev_log_sigs = log_sigs
+
+        pause = delay
+        if ready_since is not None:
+            # Everything is idle and we are waiting out IDLE_CONFIRMATION,
+            # so poll again as soon as it has passed rather than up to a
+            # full poll interval later.
+            remaining = ready_since + IDLE_CONFIRMATION - now
+            pause = max(0, min(delay, remaining.total_seconds()))
+        time.sleep(pause)
 
 
 if __name__ == '__main__':
@@ -49,4 +49,5 @@ setup(
                  'Programming Language :: Python :: 3'],
     keywords='juju',
     install_requires=['PyYAML'],
+    extras_require={'orjson': ['orjson']},
     entry_points={'console_scripts': ['juju-wait = juju_wait:wait_cmd']})